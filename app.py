@@ -1,43 +1,104 @@
 import streamlit as st
 import requests
-from docx import Document
-from docx.shared import Inches, Pt
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.oxml.ns import qn
-from docx.oxml import OxmlElement
-from io import BytesIO
-import re
+from requests.adapters import HTTPAdapter
+from io import StringIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import random
+import threading
+import time
+
+# Límites para las llamadas concurrentes a la API de Gemini
+MAX_CONCURRENT_REQUESTS = 8  # Mantenerse por debajo del límite de peticiones por minuto
+MAX_RETRIES = 3  # Intentos por capítulo ante errores 429/5xx
+REQUEST_TIMEOUT = (5, 120)  # Segundos para conectar y para recibir la respuesta
+# Peticiones por minuto permitidas por la clave; configurable en los secretos con
+# GEMINI_RPM (por defecto 15, el límite del nivel gratuito de gemini-2.0-flash)
+RPM_LIMIT = int(st.secrets.get("GEMINI_RPM", 15))
+
+# Plantilla Word con página de 5.5 x 8.5 pulgadas, márgenes de 0.8 y estilos
+# "Normal", "Body Text", "Heading 1" y "Heading 2" ya definidos en Times New Roman
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "template.docx")
+
+# Sesión HTTP compartida por todo el proceso para reutilizar conexiones TLS;
+# cache_resource evita crear una nueva en cada reejecución del script
+@st.cache_resource(show_spinner=False)
+def _get_session():
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+    return session
+
+# Cubeta de fichas única por proceso: la comparten todas las sesiones y reejecuciones,
+# ya que todas usan la misma clave de API
+@st.cache_resource(show_spinner=False)
+def _get_rate_limiter():
+    bucket = {"tokens": float(RPM_LIMIT), "refill_time": time.monotonic()}
+    return bucket, threading.Lock()
+
+def _acquire():
+    """Espera hasta que haya una ficha disponible en la cubeta y la consume."""
+    bucket, bucket_lock = _get_rate_limiter()
+    refill_rate = RPM_LIMIT / 60  # Fichas por segundo
+    while True:
+        with bucket_lock:
+            now = time.monotonic()
+            bucket["tokens"] = min(RPM_LIMIT, bucket["tokens"] + (now - bucket["refill_time"]) * refill_rate)
+            bucket["refill_time"] = now
+            if bucket["tokens"] >= 1:
+                bucket["tokens"] -= 1
+                return
+            wait = (1 - bucket["tokens"]) / refill_rate
+        time.sleep(wait)
+
+# Error para respuestas de la API que no contienen texto generado
+class EmptyResponseError(Exception):
+    """La respuesta de Gemini no trae texto (p. ej. bloqueada por filtros de seguridad)."""
+
+# Tabla de traducción para eliminar caracteres especiales de Markdown
+_MD_STRIP = str.maketrans('', '', '#*_`')
 
 # Función para limpiar Markdown
 def clean_markdown(text):
     """Elimina marcas de Markdown del texto."""
-    text = re.sub(r'[#*_`]', '', text)  # Eliminar caracteres especiales de Markdown
+    text = text.translate(_MD_STRIP)  # Eliminar caracteres especiales de Markdown
     return text.strip()
 
-# Función para procesar listas y diálogos, reemplazando guiones por rayas
-def process_dialogues_and_lists(text):
-    """
-    Procesa el texto para:
-    1. Reemplazar guiones ('-') al inicio de las listas o diálogos por rayas ('—').
-    2. Asegurar que después de las listas haya un salto de párrafo.
-    """
-    lines = text.split('\n')  # Divide el texto en líneas
-    processed_lines = []
+# Generador que procesa las líneas de listas y diálogos una a una
+def _process_lines(lines):
+    """Produce cada línea limpia, con rayas en listas/diálogos y un salto tras ellas."""
     in_list = False  # Indicador para saber si estamos dentro de una lista o diálogo
 
     for line in lines:
         stripped_line = line.strip()
         if stripped_line.startswith('-'):  # Detectar líneas que comienzan con un guion
-            processed_line = stripped_line.replace('-', '—', 1)
-            processed_lines.append(processed_line)
+            yield '—' + stripped_line[1:]
             in_list = True
         else:
             if in_list:
-                processed_lines.append("")  # Salto de párrafo
+                yield ""  # Salto de párrafo
                 in_list = False
-            processed_lines.append(stripped_line)
+            yield stripped_line
 
-    return '\n\n'.join(processed_lines)
+# Función para procesar listas y diálogos, reemplazando guiones por rayas
+def process_dialogues_and_lists(text):
+    """
+    Procesa el texto para:
+    1. Reemplazar guiones ('-') al inicio de las listas o diálogos por rayas ('—').
+    2. Asegurar que después de las listas haya un salto de párrafo.
+    """
+    return '\n\n'.join(_process_lines(StringIO(text)))  # Iterar líneas sin crear una lista
+
+# Generador que recorre los párrafos de un capítulo sin dividir todo el texto
+def _iter_paragraphs(text):
+    """Produce cada párrafo (separado por líneas en blanco) en una sola línea."""
+    start = 0
+    while True:
+        end = text.find('\n\n', start)
+        if end == -1:
+            yield text[start:].replace('\n', ' ').strip()
+            return
+        yield text[start:end].replace('\n', ' ').strip()
+        start = end + 2
 
 # Función para aplicar reglas de capitalización según el idioma
 def format_title(title, language):
@@ -47,13 +108,16 @@ def format_title(title, language):
     - Otros idiomas: Mayúscula inicial en cada palabra.
     """
     if language.lower() == "spanish":
-        words = title.split()
-        formatted_words = [words[0].capitalize()] + [word.lower() if word.islower() else word for word in words[1:]]
-        return " ".join(formatted_words)
+        first, sep, rest = " ".join(title.split()).partition(" ")
+        return first.capitalize() + sep + rest
     else:
         return title.title()
 
 # Función para generar un capítulo usando Google Gemini
+# Se memoriza por sus argumentos durante un día para no regenerar capítulos sin cambios
+# (como máximo unas diez obras completas en memoria); los errores se propagan como
+# excepciones y por tanto nunca quedan en caché.
+@st.cache_data(ttl=86400, max_entries=500, show_spinner=False)
 def generate_chapter(api_key, topic, audience, chapter_number, language, table_of_contents="", specific_instructions="", is_intro=False, is_conclusion=False):
     url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={api_key}"
     
@@ -81,13 +145,24 @@ def generate_chapter(api_key, topic, audience, chapter_number, language, table_o
         }
     }
     
+    # Reintentar con espera exponencial ante límites de tasa (429) o errores del servidor (5xx)
+    for attempt in range(MAX_RETRIES):
+        _acquire()
+        try:
+            response = _get_session().post(url, json=data, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            break
+        except requests.RequestException as e:
+            status = e.response.status_code if e.response is not None else None
+            retryable = status is None or status == 429 or status >= 500
+            if not retryable or attempt == MAX_RETRIES - 1:
+                raise
+            time.sleep(2 ** attempt + random.random())  # Espera exponencial con fluctuación
+    response_json = response.json()
     try:
-        response = requests.post(url, json=data)
-        response.raise_for_status()
-        content = response.json().get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "Error generating the chapter.")
-    except requests.RequestException as e:
-        st.error(f"Error al generar el capítulo {chapter_number}: {str(e)}")
-        return "Error al generar el capítulo."
+        content = response_json["candidates"][0]["content"]["parts"][0]["text"]
+    except (KeyError, IndexError, TypeError) as e:
+        raise EmptyResponseError(f"Respuesta sin texto generado: {e!r}") from e
     
     # Procesar diálogos y listas
     processed_content = process_dialogues_and_lists(content)
@@ -96,36 +171,36 @@ def generate_chapter(api_key, topic, audience, chapter_number, language, table_o
 
 # Función para agregar numeración de páginas al documento Word
 def add_page_numbers(doc):
+    # Importaciones diferidas: python-docx solo se necesita al crear el documento
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import nsdecls
+
+    # Campo PAGE completo (inicio, instrucción y fin) dentro de un único run
+    page_field_xml = (
+        f'<w:r {nsdecls("w")}>'
+        '<w:fldChar w:fldCharType="begin"/>'
+        '<w:instrText xml:space="preserve">PAGE</w:instrText>'
+        '<w:fldChar w:fldCharType="end"/>'
+        '</w:r>'
+    )
+
     for section in doc.sections:
         footer = section.footer
         paragraph = footer.paragraphs[0] if footer.paragraphs else footer.add_paragraph()
         paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        run = paragraph.add_run()
-        fldChar = OxmlElement('w:fldChar')
-        fldChar.set(qn('w:fldCharType'), 'begin')
-        instrText = OxmlElement('w:instrText')
-        instrText.set(qn('xml:space'), 'preserve')
-        instrText.text = "PAGE"
-        fldChar2 = OxmlElement('w:fldChar')
-        fldChar2.set(qn('w:fldCharType'), 'end')
-        run._r.append(fldChar)
-        run._r.append(instrText)
-        run._r.append(fldChar2)
+        paragraph._p.append(parse_xml(page_field_xml))
 
 # Función para crear un documento Word con formato específico
 def create_word_document(chapters, title, author_name, author_bio, language):
-    doc = Document()
-
-    # Configurar el tamaño de página (5.5 x 8.5 pulgadas)
-    section = doc.sections[0]
-    section.page_width = Inches(5.5)
-    section.page_height = Inches(8.5)
+    # Importaciones diferidas: python-docx solo se necesita al crear el documento
+    from docx import Document
+    from docx.shared import Pt
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    from io import BytesIO
 
-    # Configurar márgenes de 0.8 pulgadas en todo
-    section.top_margin = Inches(0.8)
-    section.bottom_margin = Inches(0.8)
-    section.left_margin = Inches(0.8)
-    section.right_margin = Inches(0.8)
+    # La plantilla ya trae el tamaño de página, los márgenes y las fuentes de cada estilo
+    doc = Document(TEMPLATE_PATH)
 
     # Añadir y formatear el título
     formatted_title = format_title(title, language)
@@ -134,7 +209,6 @@ def create_word_document(chapters, title, author_name, author_bio, language):
     title_run = title_paragraph.add_run(formatted_title)
     title_run.bold = True
     title_run.font.size = Pt(14)
-    title_run.font.name = "Times New Roman"
 
     # Añadir nombre del autor si está proporcionado
     if author_name:
@@ -142,46 +216,32 @@ def create_word_document(chapters, title, author_name, author_bio, language):
         author_paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
         author_run = author_paragraph.add_run(author_name)
         author_run.font.size = Pt(12)
-        author_run.font.name = "Times New Roman"
         doc.add_page_break()
 
     # Añadir perfil del autor si está proporcionado
     if author_bio:
-        bio_paragraph = doc.add_paragraph("Author Information")
-        bio_paragraph.style = "Heading 2"
-        bio_paragraph.runs[0].font.size = Pt(11)
-        bio_paragraph.runs[0].font.name = "Times New Roman"
+        doc.add_paragraph("Author Information", style="Heading 2")
         doc.add_paragraph(author_bio).style = "Normal"
         doc.add_page_break()
 
-    # Añadir capítulos
+    # Añadir capítulos (el prefijo ya cumple las reglas de capitalización del idioma)
+    chapter_prefix = "Capítulo" if language.lower() == "spanish" else "Chapter"
     for i, chapter in enumerate(chapters, 1):
-        chapter_title_text = f"Chapter {i}" if language.lower() != "spanish" else f"Capítulo {i}"
-        formatted_chapter_title = format_title(chapter_title_text, language)
-        chapter_title = doc.add_paragraph(formatted_chapter_title)
-        chapter_title.style = "Heading 1"
-        chapter_title.runs[0].font.size = Pt(12)
-        chapter_title.runs[0].font.name = "Times New Roman"
-
-        paragraphs = chapter.split('\n\n')
-        for para_text in paragraphs:
-            para_text = para_text.replace('\n', ' ').strip()
-            paragraph = doc.add_paragraph(para_text)
-            paragraph.style = "Normal"
-            paragraph.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-            paragraph.paragraph_format.space_after = Pt(0)
-            for run in paragraph.runs:
-                run.font.size = Pt(11)
-                run.font.name = "Times New Roman"
+        doc.add_paragraph(f"{chapter_prefix} {i}", style="Heading 1")
+
+        # El estilo "Body Text" de la plantilla ya es justificado y sin espacio posterior
+        for para_text in _iter_paragraphs(chapter):
+            doc.add_paragraph(para_text, style="Body Text")
 
         doc.add_page_break()
 
     add_page_numbers(doc)
 
+    # Serializar y liberar el árbol del documento antes de devolver los bytes
     buffer = BytesIO()
     doc.save(buffer)
-    buffer.seek(0)
-    return buffer
+    del doc
+    return buffer.getvalue()
 
 # Configuración de Streamlit
 st.set_page_config(page_title="Automatic Book Generator", page_icon="📚")
@@ -230,6 +290,7 @@ author_name = st.text_input("🖋️ Nombre del Autor (opcional):")
 author_bio = st.text_area("👤 Perfil del Autor (opcional):", placeholder="Descripción profesional breve o biografía.")
 languages = ["English", "Spanish", "French", "German", "Chinese", "Japanese", "Russian", "Portuguese", "Italian", "Arabic", "Medieval Latin", "Koine Greek"]
 selected_language = st.selectbox("🌐 Elige el idioma del libro:", languages)
+regenerate = st.checkbox("🔄 Regenerar capítulos (ignorar la caché)", value=False)
 
 # Estado de Streamlit para almacenar los capítulos generados
 if 'chapters' not in st.session_state:
@@ -241,47 +302,70 @@ if st.button("🚀 Generar Libro"):
         st.error("Por favor, introduce un tema y una audiencia objetivo válidos.")
         st.stop()
 
-    chapters = []
+    # Descartar los capítulos memorizados para obtener un borrador nuevo
+    if regenerate:
+        generate_chapter.clear()
 
-    # Generar introducción si está seleccionada
+    # Lista ordenada de secciones a generar: (etiqueta, argumentos de generate_chapter)
+    jobs = []
     if include_intro:
-        st.write("⏳ Generando introducción...")
-        intro_content = generate_chapter(api_key, topic, audience, 0, selected_language.lower(), table_of_contents, specific_instructions, is_intro=True)
-        chapters.append(intro_content)
-        word_count = len(intro_content.split())
-        with st.expander(f"🌟 Introducción ({word_count} palabras)"):
-            st.write(intro_content)
-
-    # Generar capítulos principales
-    progress_bar = st.progress(0)
+        jobs.append(("🌟 Introducción", {"chapter_number": 0, "is_intro": True}))
     for i in range(1, num_chapters + 1):
-        st.write(f"⏳ Generando capítulo {i}...")
-        chapter_content = generate_chapter(api_key, topic, audience, i, selected_language.lower(), table_of_contents, specific_instructions)
-        word_count = len(chapter_content.split())
-        chapters.append(chapter_content)
-        with st.expander(f"📖 Capítulo {i} ({word_count} palabras)"):
-            st.write(chapter_content)
-        progress_bar.progress(i / num_chapters)
-
-    # Generar conclusiones si están seleccionadas
+        jobs.append((f"📖 Capítulo {i}", {"chapter_number": i}))
     if include_conclusion:
-        st.write("⏳ Generando conclusiones...")
-        conclusion_content = generate_chapter(api_key, topic, audience, 0, selected_language.lower(), table_of_contents, specific_instructions, is_conclusion=True)
-        word_count = len(conclusion_content.split())
-        chapters.append(conclusion_content)
-        with st.expander(f"🔚 Conclusiones ({word_count} palabras)"):
-            st.write(conclusion_content)
+        jobs.append(("🔚 Conclusiones", {"chapter_number": 0, "is_conclusion": True}))
+
+    # Generar todas las secciones en paralelo; las llamadas a la API son solo espera de red
+    st.write(f"⏳ Generando {len(jobs)} secciones...")
+    progress_bar = st.progress(0)
+    chapters = [None] * len(jobs)
+    executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+    try:
+        futures = {
+            executor.submit(
+                generate_chapter, api_key, topic, audience,
+                language=selected_language.lower(),
+                table_of_contents=table_of_contents,
+                specific_instructions=specific_instructions,
+                **kwargs
+            ): index
+            for index, (_, kwargs) in enumerate(jobs)
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            index = futures[future]
+            try:
+                chapters[index] = future.result()
+            except (requests.RequestException, EmptyResponseError) as e:
+                st.error(f"Error al generar el capítulo {jobs[index][1]['chapter_number']}: {str(e)}")
+                chapters[index] = "Error al generar el capítulo."
+            progress_bar.progress(done / len(jobs))
+    finally:
+        # Si Streamlit interrumpe la ejecución (p. ej. por una reejecución), no esperar
+        # a las secciones pendientes: se cancelan las que aún no han empezado
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # Mostrar las secciones en el orden del libro
+    for (label, _), content in zip(jobs, chapters):
+        word_count = len(content.split())
+        with st.expander(f"{label} ({word_count} palabras)"):
+            st.write(content)
 
     st.session_state.chapters = chapters
 
 # Mostrar opciones de descarga si hay capítulos generados
 if st.session_state.chapters:
     st.subheader("⬇️ Opciones de Descarga")
-    word_file = create_word_document(st.session_state.chapters, topic, author_name, author_bio, selected_language.lower())
+
+    # Reutilizar el documento ya generado si no cambió ninguna entrada que lo afecte
+    docx_key = (tuple(st.session_state.chapters), topic, author_name, author_bio, selected_language)
+    cached = st.session_state.get("docx_cache")
+    if cached is None or cached[0] != docx_key:
+        word_file = create_word_document(st.session_state.chapters, topic, author_name, author_bio, selected_language.lower())
+        st.session_state.docx_cache = (docx_key, word_file)
 
     st.download_button(
         label="📥 Descargar en Word",
-        data=word_file.getvalue(),
+        data=st.session_state.docx_cache[1],
         file_name=f"{topic}.docx",
         mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
     )